@@ -27,7 +27,7 @@ try:
     dataset = sys.argv[1].lower()  # imagenet, cifar10
     is_imagenet = dataset == 'imagenet'
     ghn = GHN2(dataset)
-except:
+except (IndexError, OSError):  # missing arguments or no checkpoint for the dataset
     print('\nExample of usage: python examples/all_torch_models.py cifar10\n')
     raise
 
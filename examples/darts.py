@@ -15,10 +15,14 @@ Example:
 
     python examples/darts.py imagenet
 
+    # to check that the decoders compiled with torch.compile predict the same parameters
+    python examples/darts.py imagenet compile
+
 """
 
 
 import sys
+import copy
 from ppuda.vision.loader import image_loader
 from ppuda.ghn.nn import GHN2
 from ppuda.deepnets1m.genotypes import DARTS
@@ -27,8 +31,9 @@ from ppuda.utils import capacity, infer
 
 try:
     dataset = sys.argv[1].lower()   # imagenet, cifar10
-    ghn = GHN2(dataset)
-except:
+    use_compile = len(sys.argv) > 2 and sys.argv[2].lower() == 'compile'
+    ghn = GHN2(dataset, use_compile=use_compile)
+except (IndexError, OSError):  # missing arguments or no checkpoint for the dataset
     print('\nExample of usage: python examples/darts.py imagenet\n')
     raise
 
@@ -49,6 +54,14 @@ model = Network(C=48 if is_imagenet else 36,
 
 model = ghn(model)  # Predict all parameters for DARTS
 
+if use_compile:
+    # Smoke check of the compiled decoders: the parameters must be close to the ones predicted by the eager GHN
+    model_eager = GHN2(dataset)(copy.deepcopy(model))
+    diff = max((p1 - p2).abs().max().item() for p1, p2 in zip(model.parameters(), model_eager.parameters()))
+    print('\nMax difference between the parameters predicted by the compiled and eager GHNs: {:.2e}'.format(diff))
+    if diff > 1e-4:
+        print('WARNING: the parameters predicted by the compiled GHN appear to be different from expected!')
+
 # To eval the DARTS model trained on ImageNet
 # model = load_DARTS_pretrained(model.eval())[0].to('cuda')
 
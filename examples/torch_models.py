@@ -30,7 +30,7 @@ try:
     arch = sys.argv[2].lower()  # resnet50, wide_resnet101_2, etc.
 
     ghn = GHN2(dataset)
-except:
+except (IndexError, OSError):  # missing arguments or no checkpoint for the dataset
     print('\nExample of usage: python examples/torch_models.py imagenet resnet50\n')
     raise
 
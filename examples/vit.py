@@ -31,7 +31,7 @@ from ppuda.utils import capacity, infer
 try:
     dataset = sys.argv[1].lower()   # imagenet, cifar10
     ghn = GHN2(dataset)
-except:
+except (IndexError, OSError):  # missing arguments or no checkpoint for the dataset
     print('\nExample of usage: python examples/vit.py imagenet\n')
     raise
 
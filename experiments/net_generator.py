@@ -40,7 +40,7 @@ def main():
         split = sys.argv[1].lower()
         N = int(sys.argv[2])
         data_dir = sys.argv[3]
-    except:
+    except (IndexError, ValueError):
         print('\nExample of usage: python deepnets1m/net_generator.py train 1000000 ./data\n')
         raise
 
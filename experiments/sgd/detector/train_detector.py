@@ -101,7 +101,7 @@ def get_backbone(args):
                     'C_mult': int(genotype != ViT) + 1,  # assume either ViT or DARTS-style architecture
                     'preproc': genotype != ViT,
                     'stem_type': 1}  # assume that the ImageNet-style stem is used by default
-    except:
+    except (SyntaxError, AttributeError):
         deepnets = DeepNets1M(split=args.split,
                               nets_dir=args.data_dir,
                               large_images=True,
@@ -32,6 +32,7 @@ import os
 from ppuda.config import init_config
 from ppuda.vision.loader import image_loader
 from ppuda.deepnets1m.net import Network
+from ppuda.deepnets1m.ops import fuse_model, FAST_BN
 from ppuda.deepnets1m.loader import DeepNets1M
 from ppuda.deepnets1m.genotypes import ViT, DARTS
 import ppuda.deepnets1m.genotypes as genotypes
@@ -115,6 +116,9 @@ def main():
                  verbose=args.debug > 1)
 
     model = model.train().to(args.device)
+    if args.channels_last:
+        torch.backends.cudnn.benchmark = True  # pick the fastest conv algorithms for the fixed input size
+        model = model.to(memory_format=torch.channels_last)  # convs then produce channels_last outputs
 
     print('Training arch={} with {} parameters'.format(args.arch, capacity(model)[1]))
 
@@ -143,6 +147,11 @@ def main():
                       log_interval=args.log_interval,
                       amp=args.amp)
 
+    if args.epochs == 0 and FAST_BN:
+        # the model is only evaluated, so BN with running statistics can be folded into the preceding convs
+        torch.backends.cudnn.benchmark = True
+        model = fuse_model(model.eval())
+
     for epoch in range(max(1, args.epochs)):  # if args.epochs=0, then just evaluate the model
 
         if args.epochs > 0:
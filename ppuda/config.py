@@ -38,7 +38,7 @@ env['torch'] = torch.__version__
 env['torchvision'] = torchvision.__version__
 try:
     assert list(map(lambda x: float(x), env['torch'].split('.')[:2])) >= [1, 9]
-except:
+except (AssertionError, ValueError):
     print('WARNING: PyTorch version {} is used, but version >= 1.9 is strongly recommended for this repo!'.format(env['torch']))
 
 
@@ -166,6 +166,8 @@ def init_config(mode='eval'):
             parser.add_argument('--imsize', type=int, default=224 if is_imagenet else 32,
                                 choices=[32, 224], help='image size used to train and eval models')
             parser.add_argument('--val', action='store_true', default=False, help='evaluate on the validation set')
+            parser.add_argument('--channels_last', action='store_true', default=False,
+                                help='use the channels_last memory format and cudnn benchmarking (faster convolutions on recent GPUs)')
 
     args = parser.parse_args()
 
@@ -18,7 +18,7 @@ import torch.nn.parallel.scatter_gather as scatter_gather
 import networkx as nx
 import matplotlib.pyplot as plt
 from matplotlib import cm as cm
-from .ops import NormLayers, PosEnc
+from .ops import NormLayers, PosEnc, Transformer, eager_ops
 from .net import get_cell_ind
 from .genotypes import PRIMITIVES_DEEPNETS1M
 
@@ -105,9 +105,13 @@ class GraphBatch():
         if isinstance(device, (tuple, list)):
             device = device[0]
         self._cat()
-        self.n_nodes = self.n_nodes.to(device)
-        self.node_feat = self.node_feat.to(device)
-        self.edges = self.edges.to(device)
+        # copy from pinned memory asynchronously, so that the copies overlap with the work on the cpu
+        non_blocking = torch.device(device).type == 'cuda'
+        for key in ['n_nodes', 'node_feat', 'edges']:
+            t = getattr(self, key)
+            if non_blocking and not t.is_cuda:
+                t = t.pin_memory()
+            setattr(self, key, t.to(device, non_blocking=non_blocking))
         return self
 
 
@@ -361,7 +365,8 @@ class Graph():
 
             return node_link, fn_name
 
-        var = self.model(torch.randn(1, *self.expected_input_sz))
+        with eager_ops():
+            var = self.model(torch.randn(1, *self.expected_input_sz))
         # take only the first output, but can in principle handle multiple outputs, e.g. from auxiliary classifiers
         traverse_graph((var[0] if isinstance(var, (tuple, list)) else var).grad_fn)  # populate nodes and edges
 
@@ -443,10 +448,13 @@ class Graph():
                             keep = i < len(self._nodes) - 1 and not self._nodes[i + 1]['param_name'].startswith('cells.')
 
                     elif op_name.startswith('Mul'):
-                        keep = self._nodes[i - 2]['param_name'].startswith('Hard')      # CSE op
+                        # CSE op: the input is multiplied by the gate (Hardswish -> View -> Mul)
+                        keep = any(self._nodes[j]['param_name'].startswith('View') and
+                                   any(self._nodes[k]['param_name'].startswith('Hard') for k in np.where(self._Adj[:, j])[0])
+                                   for j in np.where(self._Adj[:, i])[0])
 
                     elif op_name.startswith('Clone'):
-                        keep = self._nodes[i - 11]['param_name'].startswith('Softmax')  # MSA op
+                        keep = self._follows_attention(i)  # MSA op
 
                     elif op_name.startswith('Cat') or op_name.startswith('Add'):        # Concat and Residual (Sum) ops
                         keep = len(np.where(self._Adj[:, i])[0]) > 1  # keep only if > 1 edges are incoming
@@ -469,9 +477,43 @@ class Graph():
                 self._Adj = self._Adj[:, ind_keep][ind_keep, :]
                 self._nodes = [self._nodes[i] for i in ind_keep]
 
+        # Each Transformer op must be represented by one msa node, otherwise the graph differs from the graphs GHNs were trained on.
+        # Only the Transformer ops whose parameters are in the graph are counted, since the outputs of some ops are not used.
+        modules = set(id(node['module']) for node in self._nodes if node['module'] is not None)
+        n_msa = sum(isinstance(m, Transformer) and any(id(m_) in modules for m_ in m.modules()) for m in self.model.modules())
+        n_msa_nodes = sum(node['param_name'].startswith('Clone') for node in self._nodes)
+        if n_msa > 0 and n_msa_nodes != n_msa:
+            print('WARNING: {} msa nodes found in the graph for {} Transformer ops'.format(n_msa_nodes, n_msa))
+
         return
 
 
+    def _follows_attention(self, node_ind, max_depth=12):
+        r"""
+        Checks if the node is preceded by the attention op (softmax or fused scaled dot product attention)
+        without any parameter nodes in between. Used to find the output of multi-head self-attention.
+        :param node_ind: index of the node in the graph
+        :param max_depth: maximum number of nodes between the node and the attention op
+        :return: True if the node follows the attention op
+        """
+        frontier, visited = [node_ind], {node_ind}
+        for _ in range(max_depth):
+            prev_nodes = []
+            for j in frontier:
+                for i in np.where(self._Adj[:, j])[0]:
+                    if i in visited:
+                        continue
+                    visited.add(i)
+                    node = self._nodes[i]
+                    if node['module'] is not None:
+                        continue  # do not go beyond the layers with parameters
+                    if node['param_name'].startswith(('Softmax', 'ScaledDotProduct')):
+                        return True
+                    prev_nodes.append(i)
+            frontier = prev_nodes
+        return False
+
+
     def _add_virtual_edges(self, ve_cutoff=50):
         r"""
         Add virtual edges with weights equal the shortest path length between the nodes.
@@ -546,7 +588,7 @@ class Graph():
                             parts.insert(i + 2, 'op')
                             param_name = '.'.join(parts)
                             break
-                        except:
+                        except ValueError:
                             continue
 
                 name = MODULES[type(node['module'])](node['module'], param_name)
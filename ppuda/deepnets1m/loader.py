@@ -195,7 +195,7 @@ class DeepNets1M(torch.utils.data.Dataset):
                                 parts.insert(i + 2, 'op')
                                 name_op_net = '.'.join(parts)
                                 break
-                            except:
+                            except ValueError:
                                 continue
 
                 name_op_net = 'cells.%d.%s' % (cell_ind, name_op_net)
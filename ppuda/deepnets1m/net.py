@@ -13,7 +13,7 @@ Some functionality in this script is based on the DARTS code: https://github.com
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from .ops import OPS, ReLUConvBN, FactorizedReduce, PosEnc, Zero, Stride, parse_op_ks, bn_layer, lin_layer, conv_layer
+from .ops import OPS, ReLUConvBN, FactorizedReduce, PosEnc, Zero, Stride, make_op, bn_layer, lin_layer, conv_layer
 from ..utils import drop_path
 
 
@@ -58,8 +58,7 @@ class Cell(nn.Module):
         self._ops = nn.ModuleList()
         for i, (name, index) in enumerate(zip(op_names, indices)):
             stride = 2 if (reduction and index < 2 and not self._is_vit) else 1
-            name, ks = parse_op_ks(name)
-            self._ops.append(OPS[name](C_in if index <= 1 else C_out, C_out, ks, stride, norm, light))
+            self._ops.append(make_op(name, C_in if index <= 1 else C_out, C_out, stride, norm, light))
 
         self._indices = indices
 
@@ -89,7 +88,7 @@ class Cell(nn.Module):
                     h2 = drop_path(h2, drop_path_prob)
                 try:
                     s = h2 if s is None else (h1 + h2)
-                except:
+                except Exception:
                     print(h1.shape, h2.shape, self.genotype)
                     raise
 
@@ -13,64 +13,134 @@ Some functionality in this script is based on:
 """
 
 
+import os
+import re
+import sys
+import types
+import functools
+import contextlib
 import torch
 import torchvision
 import torch.nn as nn
-from einops import rearrange
+import torch.nn.functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 from .light_ops import *
 
 
+_KS_RE = re.compile(r'(\d+)x(\d+)')  # kernel size, e.g. 3x3 or 1x7
+
+
+@functools.lru_cache(maxsize=1024)
 def parse_op_ks(op):
     ks = 0
-    op_name = ''
-    is_double = False
+    n_ks = 0
+    names = []
     for s in op.split('_'):
-        ks_str = s.split('x')
-        valid_ks_str = False
-        if len(ks_str) == 2:
-            if ks > 0:
-                is_double = True
-            for i in range(2):
-                try:
-                    ks = max(ks, int(ks_str[i]))
-                    valid_ks_str = True
-                except:
-                    continue
-
-        if not valid_ks_str:
-            if len(op_name) > 0:
-                op_name += '_'
-            op_name += s
-    if is_double:
-        op_name += '2'
-    return op_name, ks
+        m = _KS_RE.fullmatch(s)
+        if m is None:
+            names.append(s)
+        else:
+            ks = max(ks, int(m.group(1)), int(m.group(2)))
+            n_ks += 1
+    op_name = '_'.join(names)
+    if n_ks > 1:
+        op_name += '2'  # e.g. conv_1x7_7x1
+    # interned names are found in OPS by identity without comparing the strings
+    return sys.intern(op_name), ks
+
+
+# Layer classes indexed by the light flag
+_CONV = {True: Conv2dLight, False: nn.Conv2d}
+_LIN = {True: LinearLight, False: nn.Linear}
+_LN = {True: LayerNormLight, False: nn.LayerNorm}
+_BN = {True: BatchNorm2dLight, False: nn.BatchNorm2d}
 
 
 def bn_layer(norm, C, light):
     if norm in [None, '', 'none']:
         norm_layer = nn.Identity()
     elif norm.startswith('bn'):
-        if light:
-            norm_layer = BatchNorm2dLight(C,
-                                           track_running_stats=norm.find('track') >= 0)
-        else:
-            norm_layer = nn.BatchNorm2d(C,
-                                        track_running_stats=norm.find('track') >= 0)
+        norm_layer = _BN[bool(light)](C, track_running_stats='track' in norm)
     else:
         raise NotImplementedError(norm)
     return norm_layer
 
 
 def ln_layer(C, light):
-    return LayerNormLight(C) if light else nn.LayerNorm(C)
+    return _LN[bool(light)](C)
 
 
 def conv_layer(light):
-    return Conv2dLight if light else nn.Conv2d
+    return _CONV[bool(light)]
 
 
 def lin_layer(light):
-    return LinearLight if light else nn.Linear
+    return _LIN[bool(light)]
+
+
+def fuse_conv_bn(op):
+    """
+    Folds BatchNorm layers into the preceding convolutions of an nn.Sequential in place.
+    Only BN layers with running statistics can be folded, so the op must be in the eval mode.
+    :param op: nn.Sequential, e.g. ReLUConvBN.op
+    :return: the number of fused conv-bn pairs
+    """
+    n_fused = 0
+    for i in range(len(op) - 1):
+        conv, bn = op[i], op[i + 1]
+        if not (isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d)):
+            continue
+        if conv.training or bn.training or bn.running_mean is None or bn.running_var is None:
+            continue  # batch statistics are used, so cannot fold
+        op[i] = fuse_conv_bn_eval(conv, bn)  # w * gamma / sqrt(var + eps), (b - mean) * gamma / sqrt(var + eps) + beta
+        op[i + 1] = nn.Identity()
+        n_fused += 1
+    return n_fused
+
+
+_HAS_SDPA = hasattr(F, 'scaled_dot_product_attention')  # PyTorch 2.0+
+
+# Set TAG_FUSE=1 to compile small pointwise-heavy ops with torch.compile (PyTorch 2.0+)
+_FUSE = os.environ.get('TAG_FUSE', '0') == '1' and hasattr(torch, 'compile')
+_EAGER = False
+
+# Set TAG_FAST_BN=1 to fold BN layers into convolutions of models that are only evaluated (see fuse_model)
+FAST_BN = os.environ.get('TAG_FAST_BN', '0') == '1'
+
+
+@contextlib.contextmanager
+def eager_ops():
+    """
+    Runs the ops in the eager mode even if TAG_FUSE=1 and computes attention explicitly instead of using fused kernels.
+    Used to build graphs, because compiled ops are not represented as separate nodes in the autograd graph
+    and the MSA op is identified by the nodes of the explicit attention (see Graph._filter_graph).
+    """
+    global _EAGER
+    prev, _EAGER = _EAGER, True
+    try:
+        yield
+    finally:
+        _EAGER = prev
+
+
+def fused(fn):
+    """
+    Decorator compiling fn with torch.compile if TAG_FUSE=1, so that chains of elementwise ops are fused.
+    :param fn: function (e.g. forward of a module)
+    :return: compiled function or fn if fusion is disabled
+    """
+    if not _FUSE:
+        return fn
+
+    # dynamic shapes avoid recompiling fn for every new shape of DeepNets-1M ops,
+    # the default mode does not use CUDA graphs, whose output buffers are reused by the next call of the same function
+    compiled = torch.compile(fn, dynamic=True)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        return (fn if _EAGER else compiled)(*args, **kwargs)
+
+    return wrapper
 
 
 NormLayers = [nn.BatchNorm2d, nn.LayerNorm, BatchNorm2dLight, LayerNormLight]
@@ -94,6 +164,18 @@ OPS = {
     'msa':  lambda C_in, C_out, ks, stride, norm, light: Transformer(C_in, dim_out=C_out, stride=stride, light=light),
     'cse':  lambda C_in, C_out, ks, stride, norm, light: ChannelSELayer(C_in, dim_out=C_out, stride=stride, light=light),
 }
+OPS = {sys.intern(k): v for k, v in OPS.items()}
+OPS_VIEW = types.MappingProxyType(OPS)  # read-only view of the available ops
+
+
+def make_op(op, C_in, C_out, stride, norm='bn', light=False):
+    """
+    Creates an op given its name in the genotype.
+    :param op: op name with the kernel size, e.g. sep_conv_3x3
+    :return: nn.Module
+    """
+    name, ks = parse_op_ks(op)  # cached
+    return OPS[name](C_in, C_out, ks, stride, norm, light)
 
 
 class ChannelSELayer(nn.Module):
@@ -138,43 +220,54 @@ class ChannelSELayer(nn.Module):
         num_channels_reduced = num_channels // reduction_ratio
         self.reduction_ratio = reduction_ratio
         self.stride = stride
-        self.fc1 = lin_layer(light)(num_channels, num_channels_reduced, bias=True)
-        self.fc2 = lin_layer(light)(num_channels_reduced, num_channels, bias=True)
+        linear = lin_layer(light)
+        self.fc1 = linear(num_channels, num_channels_reduced, bias=True)
+        self.fc2 = linear(num_channels_reduced, num_channels, bias=True)
         self.relu = nn.ReLU()
-        self.sigmoid = nn.Hardswish()
+        self.sigmoid = nn.Hardswish(inplace=True)  # Hardswish (not Hardsigmoid) is used in DeepNets-1M
 
+    @fused
     def forward(self, input_tensor):
         """
         :param input_tensor: X, shape = (batch_size, num_channels, H, W)
         :return: output tensor
         """
         batch_size, num_channels, H, W = input_tensor.size()
-        # Average along each channel
-        squeeze_tensor = input_tensor.reshape(batch_size, num_channels, -1).mean(dim=2)
+        # Average along each channel (reduces over strided inputs without reshaping them first)
+        # adaptive_avg_pool2d is not used, since it would be recognized as glob_avg when building graphs
+        squeeze_tensor = input_tensor.mean(dim=(2, 3))
 
         # channel excitation
         fc_out_1 = self.relu(self.fc1(squeeze_tensor))
         fc_out_2 = self.sigmoid(self.fc2(fc_out_1))
 
-        a, b = squeeze_tensor.size()
-        output_tensor = torch.mul(input_tensor, fc_out_2.view(a, b, 1, 1))
         if self.stride > 1:
-            output_tensor = output_tensor[:, :, ::self.stride, ::self.stride]
+            # subsample before scaling to avoid scaling the values that are dropped anyway
+            input_tensor = input_tensor[:, :, ::self.stride, ::self.stride]
+        output_tensor = input_tensor * fc_out_2.view(batch_size, num_channels, 1, 1)
         return output_tensor
 
 
 class FeedForward(nn.Module):
     def __init__(self, dim, hidden_dim, dropout = 0., light=False):
         super().__init__()
+        linear = lin_layer(light)
         self.net = nn.Sequential(
-            lin_layer(light)(dim, hidden_dim),
+            linear(dim, hidden_dim),
             nn.GELU(),
             nn.Dropout(dropout),
-            lin_layer(light)(hidden_dim, dim),
+            linear(hidden_dim, dim),
             nn.Dropout(dropout)
         )
+        self.dropout = dropout
+
+    @fused
     def forward(self, x):
-        return self.net(x)
+        if self.dropout > 0 and self.training:
+            return self.net(x)
+        # dropout is a no-op, so call the functional ops directly to avoid the module calls
+        fc1, fc2 = self.net[0], self.net[3]
+        return F.linear(F.gelu(F.linear(x, fc1.weight, fc1.bias)), fc2.weight, fc2.bias)
 
 
 class PosEnc(nn.Module):
@@ -184,7 +277,11 @@ class PosEnc(nn.Module):
         self.weight = nn.Parameter(fn(1, C, ks, ks))
 
     def forward(self, x):
-        return  x + self.weight
+        if not self.training and not torch.is_grad_enabled():
+            # inference: add in place to avoid allocating another B,C,ks,ks tensor,
+            # x is the output of the stem (see Network.forward), so it is not used elsewhere
+            return x.add_(self.weight)
+        return x + self.weight
 
 
 class Transformer(nn.Module):
@@ -223,51 +320,63 @@ class Transformer(nn.Module):
         self.heads = heads
         self.scale = dim_head ** -0.5
 
-        self.to_qkv = lin_layer(light)(dim, inner_dim * 3, bias=False)
+        linear = lin_layer(light)
+        self.to_qkv = linear(dim, inner_dim * 3, bias=False)
         self.to_out = nn.Sequential(
-            lin_layer(light)(inner_dim, dim_out),
+            linear(inner_dim, dim_out),
             nn.Dropout(dropout)
         )
 
         self.ln1 = ln_layer(dim, light)
         self.ln2 = ln_layer(dim, light)
         self.ff = FeedForward(dim, dim_out, light=light)
-        self.stride = stride
 
     def forward(self, x, mask=None):
         sz = x.shape
         if len(sz) == 4:
-            x = x.reshape(sz[0], sz[1], -1).permute(0, 2, 1)
+            x = x.flatten(2).transpose(1, 2)  # B,C,H,W -> B,HW,C (no copy for channels_last inputs)
 
         assert x.dim() == 3, (x.shape, sz)
         x_in = x
         x = self.ln1(x)
 
         b, n, _, h = *x.shape, self.heads
-        qkv = self.to_qkv(x).chunk(3, dim=-1)
-
-        q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> b h n d', h=h), qkv)
-        dots = torch.einsum('bhid,bhjd->bhij', q, k) * self.scale
+        # b n (3 h d) -> 3 b h n d
+        q, k, v = self.to_qkv(x).view(b, n, 3, h, -1).permute(2, 0, 3, 1, 4).unbind(0)
         if mask is not None:
             raise NotImplementedError('should not be used for images')
 
-        attn = dots.softmax(dim=-1)
-
-        out = torch.einsum('bhij,bhjd->bhid', attn, v)
-        out = rearrange(out, 'b h n d -> b n (h d)')
+        if _HAS_SDPA and not _EAGER:
+            # fused flash/memory-efficient attention, the attention matrix is not materialized
+            # the default scale of sdpa is the same as self.scale
+            out = F.scaled_dot_product_attention(q, k, v)
+        else:
+            # explicit attention, also used to build graphs to keep the same nodes regardless of the sdpa kernel
+            dots = torch.matmul(q, k.transpose(-2, -1)) * self.scale
+            attn = dots.softmax(dim=-1)
+            out = torch.matmul(attn, v)
+
+        out = out.transpose(1, 2)  # b h n d -> b n h d
+        if _EAGER:
+            # the output of the explicit attention is b h n d, so this is a copy whose Clone node marks the MSA op in graphs
+            out = out.contiguous()
+        out = out.reshape(b, n, -1)  # b n h d -> b n (h d), no copy if the output of sdpa is already in this layout
         out = self.to_out(out)
         # end of MSA
-        out = out + x_in  # residual
-
-        out = self.ff(self.ln2(out)) + out  # mlp + residual
+        out = self._mlp(out, x_in)
 
         if len(sz) == 4:
-            out = out.permute(0, 2, 1).view(sz)  # B,C,H,W
+            out = out.transpose(1, 2).reshape(sz)  # B,C,H,W
             if self.stride > 1:
                 out = out[:, :, ::self.stride, ::self.stride]
 
         return out
 
+    @fused
+    def _mlp(self, out, x_in):
+        out = out + x_in  # residual
+        return self.ff(self.ln2(out)) + out  # mlp + residual
+
 
 # DARTS License and code below
 """
@@ -483,14 +592,15 @@ class ReLUConvBN(nn.Module):
     def __init__(self, C_in, C_out, ks=1, stride=1, padding=0, norm='bn', double=False, light=False):
         super(ReLUConvBN, self).__init__()
         self.stride = stride
+        conv2d = conv_layer(light)
         if double:
             conv = [
-                conv_layer(light)(C_in, C_in, (1, ks), stride=(1, stride),
-                          padding=(0, padding), bias=False),
-                conv_layer(light)(C_in, C_out, (ks, 1), stride=(stride, 1),
-                          padding=(padding, 0), bias=False)]
+                conv2d(C_in, C_in, (1, ks), stride=(1, stride),
+                       padding=(0, padding), bias=False),
+                conv2d(C_in, C_out, (ks, 1), stride=(stride, 1),
+                       padding=(padding, 0), bias=False)]
         else:
-            conv = [conv_layer(light)(C_in, C_out, ks, stride=stride, padding=padding, bias=False)]
+            conv = [conv2d(C_in, C_out, ks, stride=stride, padding=padding, bias=False)]
         self.op = nn.Sequential(
             nn.ReLU(inplace=False),
             *conv,
@@ -499,44 +609,61 @@ class ReLUConvBN(nn.Module):
     def forward(self, x):
         return self.op(x)
 
+    def fuse(self):
+        if self.training:
+            return 0
+        return fuse_conv_bn(self.op)
+
 
 class DilConv(nn.Module):
     
     def __init__(self, C_in, C_out, ks, stride, padding, dilation, norm='bn', light=False):
         super(DilConv, self).__init__()
         self.stride = stride
+        conv2d = conv_layer(light)
 
         self.op = nn.Sequential(
             nn.ReLU(inplace=False),
-            conv_layer(light)(C_in, C_in, kernel_size=ks, stride=stride, padding=padding, dilation=dilation, groups=C_in, bias=False),
-            conv_layer(light)(C_in, C_out, kernel_size=1, padding=0, bias=False),
+            conv2d(C_in, C_in, kernel_size=ks, stride=stride, padding=padding, dilation=dilation, groups=C_in, bias=False),
+            conv2d(C_in, C_out, kernel_size=1, padding=0, bias=False),
             bn_layer(norm, C_out, light)
             )
 
     def forward(self, x):
         return self.op(x)
 
+    def fuse(self):
+        if self.training:
+            return 0
+        return fuse_conv_bn(self.op)
+
 
 class SepConv(nn.Module):
     
     def __init__(self, C_in, C_out, ks, stride, padding, norm='bn', light=False):
         super(SepConv, self).__init__()
         self.stride = stride
+        conv2d = conv_layer(light)
 
         self.op = nn.Sequential(
             nn.ReLU(inplace=False),
-            conv_layer(light)(C_in, C_in, kernel_size=ks, stride=stride, padding=padding, groups=C_in, bias=False),
-            conv_layer(light)(C_in, C_in, kernel_size=1, padding=0, bias=False),
+            conv2d(C_in, C_in, kernel_size=ks, stride=stride, padding=padding, groups=C_in, bias=False),
+            conv2d(C_in, C_in, kernel_size=1, padding=0, bias=False),
             bn_layer(norm, C_in, light),
-            nn.ReLU(inplace=False),
-            conv_layer(light)(C_in, C_in, kernel_size=ks, stride=1, padding=padding, groups=C_in, bias=False),
-            conv_layer(light)(C_in, C_out, kernel_size=1, padding=0, bias=False),
+            nn.ReLU(inplace=True),  # safe, since the input is the output of the layers above
+            conv2d(C_in, C_in, kernel_size=ks, stride=1, padding=padding, groups=C_in, bias=False),
+            conv2d(C_in, C_out, kernel_size=1, padding=0, bias=False),
             bn_layer(norm, C_out, light)
             )
 
     def forward(self, x):
         return self.op(x)
 
+    def fuse(self):
+        if self.training:
+            return 0
+        return fuse_conv_bn(self.op)
+
 
 class Stride(nn.Module):
     def __init__(self, stride):
@@ -556,8 +683,9 @@ class Zero(nn.Module):
 
     def forward(self, x):
         if self.stride == 1:
-            return x.mul(0.)
-        return x[:,:,::self.stride,::self.stride].mul(0.)
+            return torch.zeros_like(x)
+        B, C, H, W = x.shape
+        return x.new_zeros(B, C, (H + self.stride - 1) // self.stride, (W + self.stride - 1) // self.stride)
 
 
 class FactorizedReduce(nn.Module):
@@ -566,12 +694,56 @@ class FactorizedReduce(nn.Module):
         assert C_out % 2 == 0
         self.stride = stride
         self.relu = nn.ReLU(inplace=False)
-        self.conv_1 = conv_layer(light)(C_in, C_out // 2, 1, stride=stride, padding=0, bias=False)
-        self.conv_2 = conv_layer(light)(C_in, C_out // 2, 1, stride=stride, padding=0, bias=False)
+        conv2d = conv_layer(light)
+        self.conv_1 = conv2d(C_in, C_out // 2, 1, stride=stride, padding=0, bias=False)
+        self.conv_2 = conv2d(C_in, C_out // 2, 1, stride=stride, padding=0, bias=False)
         self.bn = bn_layer(norm, C_out, light)
 
     def forward(self, x):
+        if self.stride > 1 and not torch.is_grad_enabled():
+            # inference: ReLU commutes with subsampling, so only the pixels read by the 1x1 convs are processed
+            # instead of allocating the ReLU output at full resolution (not used to build graphs, since it has 2 ReLUs)
+            s = self.stride
+            x1 = F.relu(x[:, :, ::s, ::s])
+            x2 = F.relu(x[:, :, 1::s, 1::s])
+            out = torch.cat([F.conv2d(x1, self.conv_1.weight, self.conv_1.bias),
+                             F.conv2d(x2, self.conv_2.weight, self.conv_2.bias)], dim=1)
+            return self.bn(out)
+
         x = self.relu(x)
-        out = torch.cat([self.conv_1(x), self.conv_2(x[:,:,1:,1:] if self.stride > 1 else x)], dim=1)
+        if self.stride > 1:
+            # the strided 1x1 conv of x[:, :, 1:, 1:] is the same as the 1x1 conv of x[:, :, 1::stride, 1::stride],
+            # so subsample first to avoid making a contiguous copy of the full resolution slice in the conv
+            x2 = F.conv2d(x[:, :, 1::self.stride, 1::self.stride], self.conv_2.weight, self.conv_2.bias)
+        else:
+            x2 = self.conv_2(x)
+        out = torch.cat([self.conv_1(x), x2], dim=1)
         out = self.bn(out)
         return out
+
+
+def fuse_model(net):
+    """
+    Folds BN layers into convolutions of ReLUConvBN, DilConv and SepConv ops for faster inference.
+    Should be called after the parameters are loaded and net.eval() is called.
+    :param net: neural network (nn.Module)
+    :return: the same network with fused ops
+    """
+    for m in net.modules():
+        if isinstance(m, (ReLUConvBN, DilConv, SepConv)):
+            m.fuse()
+    return net
+
+
+def to_bf16(net):
+    """
+    Casts the parameters of convolutional and linear layers to bfloat16 to halve the memory reads of the heaviest ops.
+    Normalization layers and positional encodings are kept in float32, so the network must be run under
+    torch.autocast(device_type, dtype=torch.bfloat16) (infer does that automatically).
+    :param net: neural network (nn.Module) with the parameters already set
+    :return: the same network with bfloat16 conv and linear layers
+    """
+    for m in net.modules():
+        if isinstance(m, (nn.Conv2d, nn.Linear)):
+            m.to(dtype=torch.bfloat16)
+    return net
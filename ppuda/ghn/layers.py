@@ -74,12 +74,12 @@ class ShapeEncoder(nn.Module):
         self.embed_spatial = torch.nn.Embedding(n_s + 1, hid // 4)
         self.embed_channel = torch.nn.Embedding(n_ch + 1, hid // 4)
 
-        self.register_buffer('dummy_ind', torch.tensor([n_ch, n_ch, n_s, n_s], dtype=torch.long).view(1, 4),
-                             persistent=False)
+        self.dummy_ind = np.array([n_ch, n_ch, n_s, n_s], dtype=np.int64).reshape(1, 4)  # indices of unknown shapes
 
 
     def forward(self, x, params_map, predict_class_layers=True):
-        shape_ind = self.dummy_ind.repeat(len(x), 1)
+        # fill the shape indices on the cpu and copy them to the device at once instead of writing each value to the device
+        shape_ind = self.dummy_ind.repeat(len(x), axis=0)
 
         self.printed_warning = False
         for node_ind in params_map:
@@ -119,10 +119,11 @@ class ShapeEncoder(nn.Module):
                                   enumerate(shape_ind[node_ind])])))
                     self.printed_warning = True
 
+        shape_ind = torch.from_numpy(shape_ind).to(x.device)
+
+        # look up both channel and both spatial dimensions at once: (N, 2, hid // 4) -> (N, hid // 2)
         shape_embed = torch.cat(
-            (self.embed_channel(shape_ind[:, 0]),
-             self.embed_channel(shape_ind[:, 1]),
-             self.embed_spatial(shape_ind[:, 2]),
-             self.embed_spatial(shape_ind[:, 3])), dim=1)
+            (self.embed_channel(shape_ind[:, :2]).flatten(1),
+             self.embed_spatial(shape_ind[:, 2:]).flatten(1)), dim=1)
 
         return x + shape_embed
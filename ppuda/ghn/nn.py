@@ -12,8 +12,11 @@ Graph HyperNetworks.
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import numpy as np
 import os
+import functools
+import weakref
 from .mlp import MLP
 from .gatedgnn import GatedGNN
 from .decoder import MLPDecoder, ConvDecoder
@@ -26,6 +29,17 @@ from ..utils import capacity, default_device
 import time
 
 
+# Graphs and layered modules of the networks passed to GHN.forward in the evaluation mode.
+# The caches are kept outside of the networks, so that they are not saved/copied with the networks,
+# and are weakly keyed by the networks, so that the entries are removed together with the networks.
+_GRAPH_CACHE = weakref.WeakKeyDictionary()
+_LAYERED_CACHE = weakref.WeakKeyDictionary()
+
+# Compiled decoders of the GHNs loaded with use_compile=True (see GHN.load).
+# They are kept outside of the GHNs, so that the GHNs can be copied, pickled and replicated by DataParallel.
+_COMPILED_DECODERS = weakref.WeakKeyDictionary()
+
+
 def GHN1(dataset='imagenet'):
     """
         Loads GHN-1 trained on ImageNet or CIFAR-10.
@@ -37,15 +51,38 @@ def GHN1(dataset='imagenet'):
     return GHN.load(os.path.join(path, '../../checkpoints/ghn1_%s.pt' % dataset))
 
 
-def GHN2(dataset='imagenet'):
+def GHN2(dataset='imagenet', use_compile=False):
     """
     Loads GHN-2 trained on ImageNet or CIFAR-10.
     To load a GHN from an arbitrary checkpoint, use GHN.load(checkpoint_path).
     :param dataset: imagenet or cifar10
+    :param use_compile: True to compile the decoders with torch.compile (see GHN.load)
     :return: GHN-2 with trained weights
     """
     path = os.path.dirname(os.path.abspath(__file__))
-    return GHN.load(os.path.join(path, '../../checkpoints/ghn2_%s.pt' % dataset))
+    return GHN.load(os.path.join(path, '../../checkpoints/ghn2_%s.pt' % dataset), use_compile=use_compile)
+
+
+def _compile_decoder(module):
+    """
+    Compiles the decoder with torch.compile and falls back to the eager decoder if the compiled one fails.
+    The shapes are static (dynamic=False), because the slicing in ConvDecoder.forward does not support symbolic shapes.
+    :param module: decoder module
+    :return: function with the same arguments as the module
+    """
+    fn = [torch.compile(module, dynamic=False)]
+
+    def decode(*args, **kwargs):
+        if fn[0] is not module:
+            try:
+                return fn[0](*args, **kwargs)
+            except Exception as e:
+                print('WARNING: compiled {} failed, using the eager one: {}: {}'.format(
+                    type(module).__name__, type(e).__name__, e))
+                fn[0] = module
+        return module(*args, **kwargs)
+
+    return decode
 
 
 def ghn_parallel(ghn):
@@ -130,12 +167,17 @@ class GHN(nn.Module):
         self.bias_class = nn.Sequential(nn.ReLU(),
                                         nn.Linear(max_ch, num_classes))
 
+        self._use_compile = False  # True to use compiled decoders (see GHN.load)
+
 
     @staticmethod
-    def load(checkpoint_path, debug_level=1, device=default_device(), verbose=False):
+    def load(checkpoint_path, debug_level=1, device=default_device(), verbose=False, use_compile=False):
         state_dict = torch.load(checkpoint_path, map_location=device)
         ghn = GHN(**state_dict['config'], debug_level=debug_level).to(device).eval()
         ghn.load_state_dict(state_dict['state_dict'])
+        # The decoders have a fixed structure, so they are compiled (on first use) to reduce the overhead of launching many small ops.
+        # The graph propagation is data dependent (nonzero per node) and stays eager.
+        ghn._use_compile = use_compile and hasattr(torch, 'compile')
         if verbose:
             print('GHN with {} parameters loaded from epoch {}.'.format(capacity(ghn)[1], state_dict['epoch']))
         return ghn
@@ -169,8 +211,7 @@ class GHN(nn.Module):
                 start_time = time.time()
 
             if graphs is None:
-                graphs = GraphBatch([Graph(nets_torch, ve_cutoff=50 if self.ve else 1)])
-                graphs.to_device(self.embed.weight.device)
+                graphs = self._get_graph(nets_torch)
 
             if self.debug_level > 1:
                 valid_ops = graphs[0].num_valid_nodes(nets_torch)
@@ -196,37 +237,28 @@ class GHN(nn.Module):
         if self.layernorm:
             x = self.ln(x)
 
+        plan, flat_idx, n_1d = self._build_plan(param_groups)
+
+        # Copy the node indices of all groups to the device at once instead of one small copy per group
+        flat_idx = torch.tensor(flat_idx, dtype=torch.long)
+        if x.is_cuda:
+            flat_idx = flat_idx.pin_memory()
+        x_ = x.index_select(0, flat_idx.to(x.device, non_blocking=True))
+
+        # decoder_1d does not depend on the shapes, so it is called once for all the groups that use it
+        x_1d = self._get_decoder('decoder_1d')(x_[:n_1d]) if n_1d > 0 else None
+
         # Predict max-sized parameters for a batch of nets using decoders
         n_tensors, n_params = 0, 0
-        for key, inds in param_groups.items():
-            if len(inds) == 0:
-                continue
-            x_ = x[torch.tensor(inds, device=x.device)]
-
-            sz = key
-            is_cls = False
-            if len(sz) in [2, 3]:
-                if len(sz) == 2 and sz[1] > 0:
-                    # classification layer
-                    w = self.decoder(x_, (sz[0], sz[1], 1, 1), class_pred=True)
-                    is_cls = True
-                else:
-                    # 1d or cls-b
-                    if len(sz) == 3:
-                        w = self.decoder_1d(x_).view(len(inds), -1, 1, 1)
-                    else:
-                        w = self.decoder_1d(x_).view(len(inds), 2, -1)
-                        if len(sz) == 2 and sz[1] < 0:
-                            w = self.bias_class(w)
-                            is_cls = True
-            else:
-                assert len(sz) == 4, sz
-                w = self.decoder(x_, sz, class_pred=False)
+        for key, inds, start, decode, is_1d, is_cls in plan:
 
             if not predict_class_layers and is_cls:
-                continue  # do not set the classification parameters when fine-tuning
+                continue  # do not predict/set the classification parameters when fine-tuning
 
-            # Transfer predicted parameters (w) to the networks
+            w = decode((x_1d if is_1d else x_)[start:start + len(inds)])
+
+            # Group the parameters by their shape to tile the predicted tensors of the same shape at once
+            tiles = {}
             for ind in inds:
                 matched, _, w_ind = params_map[ind]
 
@@ -239,16 +271,32 @@ class GHN(nn.Module):
                     if len(sz) == 1:
                         # separately set for BN/LN biases as they are
                         # not represented as separate nodes in graphs
-                        w_ = w[w_ind][1 - is_w + it]
+                        row = 1 - is_w + it
                         if it == 1:
                             assert (type(m) in NormLayers and len(key) == 2 and key[1] == 0), \
                                 (type(m), key)
                     else:
-                        w_ = w[w_ind]
+                        row = None
+
+                    tiles.setdefault((tuple(sz), row), []).append((m, w_ind, is_w & ~it))
 
-                    sz_set = self._set_params(m, self._tile_params(w_, sz), is_w=is_w & ~it)
+            # Transfer predicted parameters (w) to the networks
+            for (sz, row), params in tiles.items():
+                lo = min(w_ind for _, w_ind, _ in params)
+                hi = max(w_ind for _, w_ind, _ in params) + 1
+                if hi - lo == len(params):
+                    # the predicted tensors of this shape are contiguous, so they are tiled at once without copying others
+                    w_ = self._tile_params(w[lo:hi] if row is None else w[lo:hi, row], sz, batch=True)
+                else:
+                    w_ = None  # tile each tensor separately to avoid tiling the tensors of other shapes
+                for m, w_ind, is_w in params:
+                    if w_ is None:
+                        w_set = self._tile_params(w[w_ind] if row is None else w[w_ind, row], sz)
+                    else:
+                        w_set = w_[w_ind - lo]
+                    sz_set = self._set_params(m, w_set, is_w=is_w)
                     n_tensors += 1
-                    n_params += torch.prod(torch.tensor(sz_set))
+                    n_params += sz_set.numel()  # torch.Size.numel() is a python int
 
 
         if not self.training and bn_train:
@@ -281,15 +329,16 @@ class GHN(nn.Module):
 
             if self.debug_level > 2:
                 print('predicted parameter stats:')
-                for n, p in nets_torch.named_parameters():
+                named_params = list(nets_torch.named_parameters())
+                with torch.no_grad():
+                    # compute the stats of all parameters and copy them to the cpu at once to avoid syncing for each value
+                    stats = torch.stack([torch.stack([p.min(), p.max(), p.mean(), p.std(), torch.norm(p)]).float()
+                                         for _, p in named_params]).tolist()
+                for (n, p), stats_p in zip(named_params, stats):
                     print('{:30s} ({:30s}): min={:.3f} \t max={:.3f} \t mean={:.3f} \t std={:.3f} \t norm={:.3f}'.format(
                         n[:30],
                         str(p.shape)[:30],
-                        p.min().item(),
-                        p.max().item(),
-                        p.mean().item(),
-                        p.std().item(),
-                        torch.norm(p).item()))
+                        *stats_p))
         elif self.debug_level or not self.training:
             if n_params != n_params_true:
                 print(
@@ -313,21 +362,23 @@ class GHN(nn.Module):
 
         nets_torch = [nets_torch] if type(nets_torch) not in [tuple, list] else nets_torch
 
+        # offsets of the nodes of each graph in the batch (a single sync if n_nodes is on the gpu)
+        offsets = [0] + torch.cumsum(torch.as_tensor(graphs.n_nodes), 0).tolist()
+
         for b, (node_info, net) in enumerate(zip(graphs.node_info, nets_torch)):
 
-            target_modules = net.__dict__['_layered_modules'] if self.training else named_layered_modules(net)
+            target_modules = net.__dict__['_layered_modules'] if self.training else self._get_layered(net)
 
             # print(target_modules)
-            param_ind = torch.sum(graphs.n_nodes[:b]).item()
+            param_ind = offsets[b]
 
+            matched_nodes = []
             for cell_id in range(len(node_info)):
                 for (node_ind, p_, name, sz, last_weight, last_bias) in node_info[cell_id]:
 
                     param_name = p_ if p_.endswith(('.weight', '.bias', 'in_proj_weight', 'in_proj_bias')) else p_ + '.weight'
-                    try:
-                        matched = [target_modules[cell_id][param_name]]
-                    except:
-                        matched = []
+                    matched = target_modules[cell_id].get(param_name)
+                    matched = [] if matched is None else [matched]
 
                     if len(matched) == 0:
                         if sz is not None:
@@ -343,32 +394,7 @@ class GHN(nn.Module):
                                  node_info[cell_id],
                                  target_modules[cell_id])
                     else:
-                        sz = matched[0]['sz']
-
-                        def min_sz(j):
-                            # to group predicted shapes and improve parallelization and at the same time not to predict much more than needed
-                            n = min(sz[j], self.max_shape[j])
-                            if n % 3 == 0:
-                                n = n // 3 * 4  # make multiple of 4 to be consistent with the decoder
-                            if n >= self.max_shape[j] / 2:
-                                n = self.max_shape[j]
-                            return n
-
-                        if len(sz) == 1:
-                            key = (min_sz(0), -1) if last_bias else (min_sz(0), 0)
-                        elif last_weight:
-                            key = (min_sz(0), min_sz(1))
-                        elif len(sz) == 2:
-                            key = (min_sz(0), min_sz(1), 1, 1)
-                        elif len(sz) == 3:
-                            key = (min_sz(0), min_sz(1), min_sz(2))  # e.g. layer_scale in ConvNeXt
-                        else:
-                            key = (min_sz(0), min_sz(1), sz[2], sz[3])
-
-                        if key not in mapping:
-                            mapping[key] = []
-                        params_map[param_ind + node_ind] = (matched[0], key, len(mapping[key]))
-                        mapping[key].append(param_ind + node_ind)
+                        matched_nodes.append((param_ind + node_ind, matched[0], last_weight, last_bias))
                         del target_modules[cell_id][param_name]
 
                 # Prune redundant ops in Network by setting their params to None
@@ -378,68 +404,182 @@ class GHN(nn.Module):
                         if hasattr(m['module'], 'bias') and m['module'].bias is not None:
                             m['module'].bias = None
 
+            # Group the matched parameters by their (rounded) shapes
+            for (ind, matched, _, _), key in zip(matched_nodes, self._param_keys(matched_nodes)):
+                if key not in mapping:
+                    mapping[key] = []
+                params_map[ind] = (matched, key, len(mapping[key]))
+                mapping[key].append(ind)
+
         return mapping, params_map
 
 
-    def _tile_params(self, w, target_shape):
+    def _get_decoder(self, name):
+        r"""
+        Returns the decoder or its compiled version if the GHN was loaded with use_compile=True.
+        :param name: decoder or decoder_1d
+        :return: module or function with the same arguments
+        """
+        module = getattr(self, name)
+        if not self._use_compile or getattr(self, '_is_replica', False):
+            return module  # DataParallel replicas use their own decoders, since the compiled ones are bound to the original GHN
+        compiled = _COMPILED_DECODERS.setdefault(self, {})
+        if name not in compiled:
+            compiled[name] = _compile_decoder(module)
+        return compiled[name]
+
+
+    def _build_plan(self, param_groups):
+        r"""
+        Chooses the decoder for each group of parameters, so that the parameters are predicted without branching on the keys.
+        The groups predicted by decoder_1d are placed first, so that decoder_1d can be called once for all of them.
+        :param param_groups: mapping from the group keys to node indices returned by _map_net_params
+        :return: list of (key, inds, start, decode, is_1d, is_cls) tuples, where start is the offset of inds in flat_idx,
+                 decode maps node embeddings (or outputs of decoder_1d if is_1d) to predicted tensors;
+                 flat_idx, concatenated node indices of all groups;
+                 n_1d, number of nodes predicted by decoder_1d
+        """
+        decoder = self._get_decoder('decoder')
+
+        groups = {True: [], False: []}  # is_1d: groups
+        for sz, inds in param_groups.items():
+            if len(inds) == 0:
+                continue
+            is_1d, is_cls = True, False
+            if len(sz) == 2 and sz[1] > 0:
+                # classification layer
+                decode = functools.partial(decoder, max_shape=(sz[0], sz[1], 1, 1), class_pred=True)
+                is_1d, is_cls = False, True
+            elif len(sz) == 3:
+                decode = lambda h: h.view(len(h), -1, 1, 1)
+            elif len(sz) == 2 and sz[1] < 0:
+                # cls-b: same as self.bias_class, but without the overhead of nn.Sequential
+                fc = self.bias_class[1]
+                decode = lambda h: F.linear(F.relu(h.view(len(h), 2, -1)), fc.weight, fc.bias)
+                is_cls = True
+            elif len(sz) == 2:
+                # 1d
+                decode = lambda h: h.view(len(h), 2, -1)
+            else:
+                assert len(sz) == 4, sz
+                decode = functools.partial(decoder, max_shape=sz, class_pred=False)
+                is_1d = False
+            groups[is_1d].append((sz, inds, decode, is_cls))
+
+        plan, flat_idx, n_1d = [], [], 0
+        for is_1d in [True, False]:
+            for sz, inds, decode, is_cls in groups[is_1d]:
+                plan.append((sz, inds, len(flat_idx), decode, is_1d, is_cls))
+                flat_idx.extend(inds)
+            if is_1d:
+                n_1d = len(flat_idx)
+
+        return plan, flat_idx, n_1d
+
+
+    def _get_graph(self, net):
+        r"""
+        Returns the cached graph of the network, since constructing the graph requires a forward pass.
+        If the network is modified (e.g. its modules or the shapes of its parameters are changed),
+        GHN.clear_cache(net) must be called to rebuild the graph.
+        :param net: neural network (nn.Module)
+        :return: GraphBatch with one graph on the device of the GHN
+        """
+        key = (50 if self.ve else 1, self.embed.weight.device)
+        cache = _GRAPH_CACHE.get(net)
+        if cache is None or cache[0] != key:
+            graphs = GraphBatch([Graph(net, ve_cutoff=key[0])]).to_device(key[1])
+            for graph in graphs.graphs:
+                graph.model = None  # the cached value must not reference the network to be removed with the network
+            cache = (key, graphs)
+            _GRAPH_CACHE[net] = cache
+        return cache[1]
+
+
+    @staticmethod
+    def _get_layered(net):
+        r"""
+        Returns cached named_layered_modules(net) to avoid traversing the modules on every call.
+        If the network is modified, GHN.clear_cache(net) must be called.
+        :param net: neural network (nn.Module)
+        :return: a copy of the list of dicts, so that the entries can be deleted by the caller
+        """
+        layered = _LAYERED_CACHE.get(net)
+        if layered is None:
+            layered = named_layered_modules(net)
+            _LAYERED_CACHE[net] = layered
+        # only the dicts are modified by _map_net_params, so their entries are not copied
+        return [dict(modules) for modules in layered]
+
+
+    @staticmethod
+    def clear_cache(net):
+        r"""
+        Removes the cached graph and layered modules of the network, e.g. after its modules are added, removed or replaced.
+        :param net: neural network (nn.Module)
+        """
+        _GRAPH_CACHE.pop(net, None)
+        _LAYERED_CACHE.pop(net, None)
+
+
+    def _param_keys(self, matched_nodes):
+        r"""
+        Computes the shapes of the predicted parameters used to group them (for all parameters at once using numpy).
+        :param matched_nodes: list of (node index, matched parameter, last_weight, last_bias) tuples
+        :return: list of keys
+        """
+        if len(matched_nodes) == 0:
+            return []
+
+        szs = [m['sz'] for _, m, _, _ in matched_nodes]
+        sz = np.array([(tuple(s) + (1, 1, 1))[:3] for s in szs])  # pad missing dimensions
+
+        # to group predicted shapes and improve parallelization and at the same time not to predict much more than needed
+        max_shape = np.array(self.max_shape[:3])
+        n = np.minimum(sz, max_shape)
+        n = np.where(n % 3 == 0, n // 3 * 4, n)  # make multiple of 4 to be consistent with the decoder
+        n = np.where(n >= max_shape / 2, max_shape, n).tolist()
+
+        keys = []
+        for (_, _, last_weight, last_bias), s, (n0, n1, n2) in zip(matched_nodes, szs, n):
+            if len(s) == 1:
+                key = (n0, -1) if last_bias else (n0, 0)
+            elif last_weight:
+                key = (n0, n1)
+            elif len(s) == 2:
+                key = (n0, n1, 1, 1)
+            elif len(s) == 3:
+                key = (n0, n1, n2)  # e.g. layer_scale in ConvNeXt
+            else:
+                key = (n0, n1, s[2], s[3])
+            keys.append(key)
+        return keys
+
+
+    def _tile_params(self, w, target_shape, batch=False):
         r"""
         Makes the shape of predicted parameter tensors the same as the target shape by tiling/slicing across channels dimensions.
         :param w: predicted tensor, for example of shape (64, 64, 11, 11)
         :param target_shape: tuple, for example (512, 256, 3, 3)
-        :return: tensor of shape target_shape
+        :param batch: True if the first dimension of w indexes predicted tensors, which are then tiled at once
+        :return: tensor of shape target_shape (or (len(w), *target_shape) if batch=True)
         """
-        t, s = target_shape, w.shape
-
-        # Slice first to avoid tiling a larger tensor
-        if len(t) == 1:
-            if len(s) == 2:
-                w = w[:min(t[0], s[0]), 0]
-            elif len(s) > 2:
-                w = w[:min(t[0], s[0]), 0, 0, 0]
-        elif len(t) == 2:
-            if len(s) > 2:
-                w = w[:min(t[0], s[0]), :min(t[1], s[1]), 0, 0]
-        elif len(t) == 3:
-            if len(s) > 3:
-                w = w[:min(t[0], s[0]), :min(t[1], s[1]), :min(t[2], s[2]), 0]
-        else:
-            w = w[:min(t[0], s[0]), :min(t[1], s[1]), :min(t[2], s[2]), :min(t[3], s[3])]
+        b = (slice(None),) if batch else ()
+        t, s = target_shape, w.shape[len(b):]
 
-        s = w.shape
+        # Slice first to avoid tiling a larger tensor (dimensions that are not in the target shape are dropped)
+        w = w[b + tuple(slice(min(t_, s_)) for t_, s_ in zip(t, s)) + (0,) * (len(s) - len(t))]
+
+        s = w.shape[len(b):]
         assert len(s) == len(t), (s, t)
 
-        # Tile out_channels
-        if t[0] > s[0]:
-            n_out = int(np.ceil(t[0] / s[0]))
-            if len(t) == 1:
-                w = w.repeat(n_out)[:t[0]]
-            elif len(t) == 2:
-                w = w.repeat((n_out, 1))[:t[0]]
-            elif len(t) == 3:
-                w = w.repeat((n_out, 1, 1))[:t[0]]
-            else:
-                w = w.repeat((n_out, 1, 1, 1))[:t[0]]
-
-        # Tile in_channels
-        if len(t) > 1:
-            if t[1] > s[1]:
-                n_in = int(np.ceil(t[1] / s[1]))
-                if len(t) == 2:
-                    w = w.repeat((1, n_in))[:, :t[1]]
-                elif len(t) == 3:
-                    w = w.repeat((1, n_in, 1))[:, t[1]]
-                else:
-                    w = w.repeat((1, n_in, 1, 1))[:, :t[1]]
+        # Tile out_channels and in_channels with a single repeat
+        reps = [-(-t[j] // s[j]) if j < 2 else 1 for j in range(len(t))]  # integer ceil
+        if max(reps) > 1:
+            w = w.repeat([1] * len(b) + reps)
 
         # Chop out any extra bits tiled
-        if len(t) == 1:
-            w = w[:t[0]]
-        elif len(t) == 2:
-            w = w[:t[0], :t[1]]
-        elif len(t) == 3:
-            w = w[:t[0], :t[1], :t[2]]
-        else:
-            w = w[:t[0], :t[1], :t[2], :t[3]]
+        w = w[b + tuple(slice(t_) for t_ in t)]
 
         return w
 
@@ -466,7 +606,11 @@ class GHN(nn.Module):
         else:
             assert isinstance(target_param, nn.Parameter), type(target_param)
             # copy to make sure there is no sharing of memory
-            target_param.data = tensor.clone()
+            data = target_param.data
+            if data.shape == tensor.shape and data.device == tensor.device and data.dtype == tensor.dtype:
+                data.copy_(tensor)  # reuse the memory of the parameter
+            else:
+                target_param.data = tensor.detach().clone()
 
         set_param = getattr(module, key)
         assert sz_target == set_param.shape, (sz_target, set_param.shape)
@@ -481,33 +625,38 @@ class GHN(nn.Module):
         :param is_w: True if it is a weight, False if it is a bias
         :return: normalized predicted tensor
         """
-        if p.dim() > 1:
+        is_pos_enc = p.dim() > 2 and p.shape[2] >= 11 and p.shape[0] == 1
+        if is_pos_enc:
+            assert isinstance(module, PosEnc), (p.shape, module)
+        return _normalize_impl(p, bool(is_w), is_pos_enc)
 
-            sz = p.shape
 
-            if len(sz) > 2 and sz[2] >= 11 and sz[0] == 1:
-                assert isinstance(module, PosEnc), (sz, module)
-                return p    # do not normalize positional encoding weights
+def _normalize_impl(p, is_w, is_pos_enc):
+    if p.dim() > 1:
 
-            no_relu = len(sz) > 2 and (sz[1] == 1 or sz[2] < sz[3])
-            if no_relu:
-                # layers not followed by relu
-                beta = 1.
-            else:
-                # for layers followed by rely increase the weight scale
-                beta = 2.
+        if is_pos_enc:
+            return p    # do not normalize positional encoding weights
 
-            # fan-out:
-            # p = p * (beta / (sz[0] * p[0, 0].numel())) ** 0.5
+        sz = p.shape
+        no_relu = len(sz) > 2 and (sz[1] == 1 or sz[2] < sz[3])
+        if no_relu:
+            # layers not followed by relu
+            beta = 1.
+        else:
+            # for layers followed by rely increase the weight scale
+            beta = 2.
 
-            # fan-in:
-            p = p * (beta / p[0].numel()) ** 0.5
+        # fan-out:
+        # p = p * (beta / (sz[0] * p[0, 0].numel())) ** 0.5
 
-        else:
+        # fan-in:
+        p = p * (beta / p[0].numel()) ** 0.5
 
-            if is_w:
-                p = 2 * torch.sigmoid(0.5 * p)  # BN/LN norm weight is [0,2]
-            else:
-                p = torch.tanh(0.2 * p)         # bias is [-1,1]
+    else:
+
+        if is_w:
+            p = 2 * torch.sigmoid(0.5 * p)  # BN/LN norm weight is [0,2]
+        else:
+            p = torch.tanh(0.2 * p)         # bias is [-1,1]
 
-        return p
+    return p
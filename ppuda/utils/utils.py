@@ -12,6 +12,7 @@ Utils.
 
 import os
 import random
+import contextlib
 import numpy as np
 import time
 import torch
@@ -24,6 +25,12 @@ from ..deepnets1m.genotypes import DARTS
 from .darts_utils import AvgrageMeter, accuracy, load_DARTS_pretrained
 
 
+@contextlib.contextmanager
+def _no_amp():
+    # contextlib.nullcontext is not available in Python 3.6
+    yield
+
+
 def infer(model, val_queue, verbose=False, n_batches=-1):
     """
     Tests the model on the images of val_queue.
@@ -36,7 +43,12 @@ def infer(model, val_queue, verbose=False, n_batches=-1):
     start = time.time()
 
     device = list(model.parameters())[0].data.device  # assume all parameters are on the same device
-    with torch.no_grad():
+    if hasattr(torch, 'autocast') and any(p.dtype == torch.bfloat16 for p in model.parameters()):
+        # some layers were cast with to_bf16, so the inputs of those layers must be cast as well (PyTorch 1.10+)
+        amp = torch.autocast(device.type, dtype=torch.bfloat16)
+    else:
+        amp = _no_amp()
+    with torch.no_grad(), amp:
         for b, (images, targets) in enumerate(tqdm(val_queue)):
             out = model(images.to(device, non_blocking=True))
             prec1, prec5 = accuracy(out[0] if isinstance(out, tuple) else out,
@@ -128,7 +128,7 @@ def to_few_shot(dataset, n_shots=100):
     try:
         targets = dataset.targets  # targets or labels depending on the dataset
         is_targets = True
-    except:
+    except AttributeError:
         targets = dataset.labels
         is_targets = False
 